@@ -1,35 +1,417 @@
+import asyncio
+import atexit
+import functools
+import io
 import json
+import os
+import posixpath
+import re
+import select
+import shlex
+import shutil
+import subprocess
 import threading
+import time
+import uuid
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from threading import Thread
-from paramiko import SSHClient, Ed25519Key, RSAKey, AutoAddPolicy
+from paramiko import SSHClient, Ed25519Key, RSAKey, AutoAddPolicy, PasswordRequiredException, SSHException
 
-class ThreadWithRetval(threading.Thread):
-    def __init__(self, target, args=()):
-        super().__init__(target=target, args=args)
-        self.result = None
+try:
+    import asyncssh
+except ImportError:
+    asyncssh = None
 
-    def run(self):
-        self.result = self._target(*self._args)
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
 
-    def join(self, *args):
-        super().join(*args)
-        return self.result
+# Each worker handshakes with a different node, so sshd's per-server
+# MaxStartups limit does not apply; this only bounds local threads and sockets.
+_MAX_CONNECT_WORKERS = 32
+
+# Maximum number of SSH connections kept open to a single node.
+_POOL_SIZE = 4
+
+# Seconds a pooled connection beyond the first may sit unused before it is
+# closed; also how often the pools are checked for such connections.
+_POOL_IDLE_TIMEOUT = 60
+
+# Seconds to wait for the TCP connection to a node, its SSH banner, and
+# authentication, each, so an unreachable node fails fast instead of waiting
+# out the kernel's SYN retries.
+_SSH_TIMEOUT = 10
+
+# Seconds between keepalive packets on an otherwise quiet connection, so NAT
+# and firewall state is not dropped while a pooled connection sits idle.
+_SSH_KEEPALIVE = 30
+
+# Upper bound on nodes driven at the same time by bounded fan-outs, so large
+# clusters do not all hit a shared resource such as the package mirror at
+# once.
+_MAX_FAN_OUT_WORKERS = 16
+
+# Receive window and maximum packet size advertised for every channel. The
+# paramiko defaults (2 MiB / 32 KiB) cap throughput well below line rate on
+# links with a large bandwidth-delay product; 256 KiB is the largest packet
+# OpenSSH accepts.
+_WINDOW_SIZE = 2 ** 27
+_MAX_PACKET_SIZE = 2 ** 18
+
+# Number of bytes requested per read when draining a command's output.
+_RECV_SIZE = 65536
+
+# Number of files transferred at once by scp_dir(), each on its own SFTP session.
+_SFTP_CONCURRENCY = 8
+
+# Number of SFTP read requests kept in flight while downloading a file. 64
+# requests of 32 KiB keep 2 MiB in flight, enough to keep the link busy
+# without flooding the server with requests for a large file.
+_SFTP_PIPELINE_DEPTH = 64
+
+
+# Shell scripts run by install_deps() and install_docker(). Kept at module
+# level so they are built once at import time and can be replaced by
+# callers that need a different package set.
+_INSTALL_DEPS_SH = '''
+# Each step is skipped when its packages are already installed, so re-runs
+# do not refresh the apt metadata or reinstall anything. libz-dev is a virtual
+# package and is checked through zlib1g-dev, which provides it.
+if ! dpkg -s htop powercap-utils python3 python3-pip linux-tools-$(uname -r) linux-cloud-tools-$(uname -r) git libssl-dev zlib1g-dev luarocks tcpdump > /dev/null 2>&1; then
+sudo apt-get update
+sudo apt-get install -y htop powercap-utils python3 python3-pip linux-tools-$(uname -r) linux-cloud-tools-$(uname -r) git libssl-dev libz-dev luarocks tcpdump
+fi
+# pip show succeeds if any one of several packages is found, so check them one by one.
+missing=""
+for pkg in aiohttp asyncio pandas numpy scikit-learn matplotlib psutil; do
+pip3 show "$pkg" > /dev/null 2>&1 || missing="$missing $pkg"
+done
+[ -z "$missing" ] || pip3 install $missing
+luarocks show luasocket > /dev/null 2>&1 || sudo luarocks install luasocket
+dpkg -s python3-locust > /dev/null 2>&1 || yes | sudo apt install python3-locust
+pip show locust-plugins > /dev/null 2>&1 || pip install locust-plugins
+pip show locust-swarm > /dev/null 2>&1 || pip install locust-swarm
+
+'''
+
+_INSTALL_DOCKER_SH = '''
+# Skip the installation when Docker and its compose plugin are already there.
+if ! command -v docker > /dev/null 2>&1 || ! docker compose version > /dev/null 2>&1; then
+# Add Docker's official GPG key:
+sudo apt-get update
+sudo apt-get install ca-certificates curl -y
+sudo install -m 0755 -d /etc/apt/keyrings
+sudo curl -fsSL https://download.docker.com/linux/ubuntu/gpg -o /etc/apt/keyrings/docker.asc
+sudo chmod a+r /etc/apt/keyrings/docker.asc
+
+# Add the repository to Apt sources:
+echo \
+"deb [arch=$(dpkg --print-architecture) signed-by=/etc/apt/keyrings/docker.asc] https://download.docker.com/linux/ubuntu \
+$(. /etc/os-release && echo "$VERSION_CODENAME") stable" | \
+sudo tee /etc/apt/sources.list.d/docker.list > /dev/null
+sudo apt-get update
+
+
+sudo apt-get install docker-ce docker-ce-cli containerd.io docker-buildx-plugin docker-compose-plugin -y
+fi
+
+sudo chmod 666 /var/run/docker.sock
+'''
+
+
+@functools.lru_cache(maxsize=8)
+def _read_config(path, mtime):
+    """
+    Read a server configuration file.
+
+    Cached so agents created from the same file skip re-reading it; mtime is
+    part of the cache key so an edited file is read again. The raw bytes are
+    cached rather than the parsed data, so each agent parses its own copy and
+    cannot see another agent's changes to it.
+    """
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+@functools.lru_cache(maxsize=8)
+def _load_key(path, mtime, password):
+    """
+    Load and decrypt an SSH private key.
+
+    Cached because decrypting a passphrase-protected key runs a deliberately
+    slow KDF; mtime is part of the cache key so a replaced key is reloaded.
+    The key type is detected from the file contents, not its name.
+    """
+    for key_class in (Ed25519Key, RSAKey):
+        try:
+            return key_class.from_private_key_file(path, password=password)
+        except PasswordRequiredException:
+            raise
+        except (SSHException, ValueError):
+            continue
+    raise ValueError(f"Unknown key type or wrong passphrase for {path}")
+
+
+def _read_channel(chan, capture=True):
+    """
+    Read a command's stdout and stderr from its channel until the command exits.
+
+    Both streams are drained as data arrives, so a command that fills its
+    stderr window cannot stall while stdout is being read, and the output is
+    accumulated as bytes rather than decoded line by line.
+
+    Args:
+        chan (Channel): Channel the command was started on
+        capture (bool): Whether to keep stdout, or read and discard it; stderr is
+                        always kept so that failures can still be reported
+
+    Returns:
+        tuple: (stdout_bytes, stderr_bytes, exit_status)
+    """
+    stdout = bytearray()
+    stderr = bytearray()
+    while True:
+        select.select([chan], [], [], 1.0)
+        while chan.recv_ready():
+            data = chan.recv(_RECV_SIZE)
+            if capture:
+                stdout += data
+        while chan.recv_stderr_ready():
+            stderr += chan.recv_stderr(_RECV_SIZE)
+        # Wait for EOF rather than the exit status: sshd may send the status
+        # while output is still in flight behind it.
+        if (chan.eof_received or chan.closed) and not chan.recv_ready() and not chan.recv_stderr_ready():
+            break
+    return stdout, stderr, chan.recv_exit_status()
+
+
+def _split_lines(data):
+    """Decode command output and split it into lines, keeping the line endings."""
+    return io.StringIO(data.decode("utf-8", "replace"), newline="\n").readlines()
+
+
+class _SSHPool:
+    """A small pool of SSH clients connected to the same node."""
+
+    def __init__(self, connect, client, size=_POOL_SIZE):
+        """
+        Initialize the pool with an already connected client.
+
+        Args:
+            connect (callable): Opens a new SSHClient to the node, returns None on failure
+            client (SSHClient): Connected client to seed the pool with
+            size (int): Maximum number of clients kept open to the node
+        """
+        self.connect_ = connect
+        self.size_ = size
+        # The seed client is never evicted; shells are opened on it.
+        self.primary_ = client
+        # Maps each client to the number of callers currently using it.
+        self.clients_ = {client: 0}
+        # Maps each client to when it was last released.
+        self.last_used_ = {client: time.monotonic()}
+        self.num_connecting_ = 0
+        self.lock_ = threading.Lock()
+
+    @contextmanager
+    def acquire(self):
+        """
+        Check out a client for the duration of a with block.
+
+        Hands out an idle client if there is one, otherwise opens a new
+        connection as long as the pool is below its size. Once the pool is
+        full, the least busy client is shared, since a single SSH connection
+        can still multiplex several channels.
+        """
+        client = self._checkout()
+        try:
+            yield client
+        finally:
+            self.release(client)
+
+    def _checkout(self):
+        with self.lock_:
+            client = min(self.clients_, key=self.clients_.get)
+            if self.clients_[client] == 0 or len(self.clients_) + self.num_connecting_ >= self.size_:
+                self.clients_[client] += 1
+                return client
+            self.num_connecting_ += 1
+        new_client = self.connect_()
+        with self.lock_:
+            self.num_connecting_ -= 1
+            if new_client is None:
+                client = min(self.clients_, key=self.clients_.get)
+            else:
+                client = new_client
+                self.clients_[client] = 0
+            self.clients_[client] += 1
+            return client
+
+    def release(self, client):
+        """Return a client handed out by acquire() to the pool."""
+        with self.lock_:
+            self.clients_[client] -= 1
+            self.last_used_[client] = time.monotonic()
+
+    def evict_idle(self, max_idle):
+        """
+        Close clients other than the seed client that have been unused for a while.
+
+        Args:
+            max_idle (float): Seconds a client may go unused before it is closed
+
+        Returns:
+            list: The clients that were closed
+        """
+        now = time.monotonic()
+        with self.lock_:
+            evicted = [client for client, users in self.clients_.items()
+                       if client is not self.primary_ and users == 0 and now - self.last_used_[client] > max_idle]
+            for client in evicted:
+                del self.clients_[client]
+                del self.last_used_[client]
+        for client in evicted:
+            client.close()
+        return evicted
+
+    def replace_primary(self, client):
+        """
+        Make a new client the seed client, if the current one is idle.
+
+        Args:
+            client (SSHClient): Connected client to take the seed client's place
+
+        Returns:
+            SSHClient: The replaced client, removed from the pool for the caller
+                       to close, or None if the seed client was in use
+        """
+        with self.lock_:
+            replaced = self.primary_
+            if self.clients_.get(replaced):
+                return None
+            del self.clients_[replaced]
+            del self.last_used_[replaced]
+            self.primary_ = client
+            self.clients_[client] = 0
+            self.last_used_[client] = time.monotonic()
+            return replaced
+
+    def close(self):
+        """Close every client in the pool."""
+        with self.lock_:
+            for client in self.clients_:
+                client.close()
+            self.clients_.clear()
+            self.last_used_.clear()
+
+
+class _Shell:
+    """A long-lived bash process on a node that runs one command at a time."""
+
+    def __init__(self, client):
+        """
+        Start a non-interactive bash reading commands from stdin.
+
+        Args:
+            client (SSHClient): Connected client to open the shell's channel on
+        """
+        self.chan_ = client.get_transport().open_session()
+        self.chan_.exec_command("bash -s")
+        self.lock_ = threading.Lock()
+
+    @property
+    def closed(self):
+        return self.chan_.closed or self.chan_.exit_status_ready()
+
+    def run(self, cmd):
+        """
+        Run a command in the shell and wait for it to finish.
+
+        The end of the command's output is delimited by a random marker echoed
+        after it on both stdout and stderr, followed on stdout by the command's
+        exit status. The command's stdin is /dev/null so it cannot consume the
+        marker lines. If the command makes the shell exit, the channel's exit
+        status is returned instead.
+
+        Returns:
+            tuple: (stdout_bytes, stderr_bytes, exit_status)
+        """
+        marker = uuid.uuid4().hex
+        out_marker = f"\n{marker} ".encode()
+        err_marker = f"\n{marker}\n".encode()
+        chan = self.chan_
+        with self.lock_:
+            chan.sendall(f"{{\n{cmd}\n}} < /dev/null\nprintf '\\n{marker} %d\\n' $?\nprintf '\\n{marker}\\n' >&2\n".encode())
+            stdout = bytearray()
+            stderr = bytearray()
+            out_end = err_end = -1
+            while True:
+                select.select([chan], [], [], 1.0)
+                while chan.recv_ready():
+                    stdout += chan.recv(_RECV_SIZE)
+                while chan.recv_stderr_ready():
+                    stderr += chan.recv_stderr(_RECV_SIZE)
+                if out_end < 0:
+                    out_end = stdout.find(out_marker)
+                if err_end < 0:
+                    err_end = stderr.find(err_marker)
+                if out_end >= 0 and err_end >= 0 and stdout.endswith(b"\n"):
+                    exit_status = int(stdout[out_end + len(out_marker):])
+                    return stdout[:out_end], stderr[:err_end], exit_status
+                if (chan.eof_received or chan.closed) and not chan.recv_ready() and not chan.recv_stderr_ready():
+                    return stdout, stderr, chan.recv_exit_status()
+
+    def close(self):
+        self.chan_.close()
 
 
 class CloudLabAgent:
     """A class to manage and run experiments on CloudLab nodes."""
+
+    # Worker join command printed by `docker swarm init`.
+    _JOIN_RE = re.compile(r"(docker swarm join --token \S+ \S+:\d+)")
+
+    _LEAVE_SWARM_CMD = "sudo docker swarm leave -f"
+
+    # cpupower command templates.
+    _GOVERNOR_CMD = "sudo cpupower frequency-set -g {governor}"
+    _FREQUENCY_CMD = "sudo cpupower -c {cpus} frequency-set -f {frequency}"
+
+    # Load generator command templates. Fields are shell-quoted before
+    # substitution, except extra_params and the path fields, which are passed
+    # through as is so that ~ and $HOME in paths still expand.
+    _WRK_CMD = ("ulimit -n {ulimit} && {wrk_path}/wrk -D {dist} -t {threads} -c {connections} -d{duration} -R{rate} "
+                "-T{timeout} -s {wrk_path}/{script} {url} {extra_params}")
+    _LOCUST_CMD = ("locust --headless -f {script} -H {url} --tag {tags} --processes {processes} -w {wait_distrib} "
+                   "-tu {throughput_per_user} -u {max_users} -r {user_spawn_rate} -t{duration} --csv {output_csv} {extra_params}")
     
-    def __init__(self, server_configs_json, with_ml_libs=False):
+    def __init__(self, server_configs_json, with_ml_libs=False, compress=True, persistent_shell=False, backend="paramiko",
+                 connect_workers=_MAX_CONNECT_WORKERS, verbose=True, lazy=False):
         """
         Initialize CloudLabAgent with server configurations.
         
         Args:
             server_configs_json (str): Path to JSON file containing server configurations
+            compress (bool): Whether to enable zlib compression on SSH connections,
+                             which trades CPU time for bandwidth
+            persistent_shell (bool): Whether run_on_node() sends commands through a
+                                     persistent shell per node (see run_on_shell())
+                                     instead of opening a channel per command
+            backend (str): "paramiko", or "asyncssh" to drive concurrent_run() and arun()
+                           from a single asyncio event loop instead of one thread per node
+            connect_workers (int): Maximum number of nodes connected to at the same time;
+                                   bounds local threads and sockets during setup
+            verbose (bool): Whether to print the output of commands that fail
+            lazy (bool): Whether to connect to each node on its first use instead of
+                         connecting to every node up front; paramiko backend only
 
         """
         # Parse server configuration.
-        with open(server_configs_json, 'r') as f:
-            json_data = json.load(f)
+        json_data = _json_loads(_read_config(server_configs_json, os.path.getmtime(server_configs_json)))
         self.account_username_ = json_data['account']['username']
         self.account_ssh_key_filename_ = json_data['account']['ssh_key_filename']
         self.ssh_port_ = json_data['account']['port']
@@ -38,31 +420,205 @@ class CloudLabAgent:
         self.ssh_suffix_ = json_data["ssh_suffix"]
         self.password_ = json_data["account"]["password"]
         self.master_node_ = json_data["master_node"]
+        # Fully qualified hostname of each node, as used to connect and in the swarm.
+        self.hostnames_ = {node: f"{node}{self.ssh_suffix_}" for node in [*self.nodes_, self.master_node_]}
+        # Experiment-network address of each "node-N" host, which CloudLab assigns as 10.0.1.(N+1).
+        self.node_ips_ = {node: f"10.0.1.{int(node.rsplit('-', 1)[-1]) + 1}"
+                          for node in [*self.nodes_, self.master_node_] if node.rsplit('-', 1)[-1].isdigit()}
         self.worker_join_token_ = ""
+        self.compress_ = compress
+        # Per-node overrides of compress_, set by set_compression().
+        self.node_compress_ = {}
+        self.persistent_shell_ = persistent_shell
+        self.verbose_ = verbose
+        if backend not in ("paramiko", "asyncssh"):
+            raise ValueError(f"Unknown backend '{backend}', expected 'paramiko' or 'asyncssh'")
+        if backend == "asyncssh" and asyncssh is None:
+            raise ImportError("The asyncssh backend requires the asyncssh package")
+        self.backend_ = backend
+        if lazy and backend != "paramiko":
+            raise ValueError("Lazy connecting is only supported by the paramiko backend")
 
         self.ssh_clients_ = {}
         self.unconnected_nodes_ = []
+        # Maps each node that failed to connect to (exception_name, message).
+        self.connect_errors_ = {}
+        self.ssh_pools_ = {}
+        # Serializes connection attempts to each node.
+        self.connect_locks_ = {}
+        # Persistent shells per node used by run_on_shell().
+        self.shells_ = {}
+        self.shells_lock_ = threading.Lock()
+        # Idle SFTP sessions per pooled SSHClient, reused across scp()/scpget() calls.
+        self.sftp_clients_ = {}
+        self.sftp_lock_ = threading.Lock()
+
+        key = _load_key(self.account_ssh_key_filename_, os.path.getmtime(self.account_ssh_key_filename_), self.password_)
+        self.pkey_ = key
 
-        if "ed25519" in self.account_ssh_key_filename_:
-            key = Ed25519Key.from_private_key_file(self.account_ssh_key_filename_, password=self.password_)
-        elif "id_rsa" in self.account_ssh_key_filename_:
-            key = RSAKey.from_private_key_file(self.account_ssh_key_filename_, password=self.password_)
+        if not lazy:
+            with ThreadPoolExecutor(max_workers=max(1, min(connect_workers, len(self.nodes_)))) as ex:
+                list(ex.map(self._add_node, self.nodes_))
+
+        # Worker threads shared by every concurrent_run() call.
+        self.executor_ = ThreadPoolExecutor(max_workers=max(8, self.num_nodes), thread_name_prefix="cloudlab")
+        atexit.register(self.close)
+
+        self.evict_stop_ = threading.Event()
+        # The thread holds only a weak reference so it does not keep an
+        # unclosed agent alive.
+        Thread(target=self._evict_idle_clients, args=(weakref.ref(self), self.evict_stop_), daemon=True).start()
+
+        # asyncssh connections live on an event loop running in a background
+        # thread; the paramiko connections above still serve SFTP and shells.
+        self.loop_ = None
+        self.async_conns_ = {}
+        if self.backend_ == "asyncssh":
+            self.loop_ = asyncio.new_event_loop()
+            Thread(target=self.loop_.run_forever, daemon=True).start()
+            self.async_conns_ = self._run_coroutine(self._aconnect_all())
+
+    def _run_coroutine(self, coro):
+        """Run a coroutine on the agent's event loop and wait for its result."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop_).result()
+
+    async def _aconnect_all(self):
+        """
+        Open an asyncssh connection to every connected node concurrently.
+
+        Returns:
+            dict: Dictionary mapping node identifiers to their SSHClientConnection
+        """
+        compression_algs = ["zlib@openssh.com", "zlib", "none"] if self.compress_ else ["none"]
+        nodes = list(self.ssh_clients_)
+        conns = await asyncio.gather(*[asyncssh.connect(self._hostname(node), port=self.ssh_port_,
+                                                        username=self.account_username_,
+                                                        client_keys=[self.account_ssh_key_filename_],
+                                                        passphrase=self.password_, known_hosts=None,
+                                                        compression_algs=compression_algs,
+                                                        connect_timeout=_SSH_TIMEOUT, login_timeout=_SSH_TIMEOUT)
+                                       for node in nodes], return_exceptions=True)
+        async_conns = {}
+        for node, conn in zip(nodes, conns):
+            if isinstance(conn, Exception):
+                print(f"Could not connect to Node {node} with asyncssh: {conn}")
+            else:
+                async_conns[node] = conn
+        return async_conns
+
+    async def _aexec(self, node, cmd, capture_output = True):
+        """
+        Execute a command on a node over its asyncssh connection.
+
+        Must run on the agent's event loop.
+
+        Returns:
+            tuple: (stdout_bytes, stderr_bytes, exit_status)
+        """
+        if node not in self.async_conns_:
+            return b"", f"Not connected to {node}\n".encode(), 255
+        if capture_output:
+            result = await self.async_conns_[node].run(cmd, encoding=None)
+            stdout, stderr = result.stdout, result.stderr
         else:
-            print("Error: Unknown key type.")
-            assert False
+            result = await self.async_conns_[node].run(cmd, stdout=asyncssh.DEVNULL, encoding=None)
+            stdout, stderr = b"", result.stderr
+        # exit_status is None when the command was killed by a signal.
+        exit_status = -1 if result.exit_status is None else result.exit_status
+        return stdout, stderr, exit_status
 
-        for node in self.nodes_:
-            print(f"Connecting to Node {node}")
-            ssh_client = SSHClient()
-            ssh_client.set_missing_host_key_policy(AutoAddPolicy())
-            try:
-                ssh_client.connect(f"{node}" + self.ssh_suffix_, self.ssh_port_, self.account_username_, pkey=key)
-            except:
-                print(f"Could not connect to Node {node}")
+    async def arun(self, node, cmd, exit_on_err = False, capture_output = True):
+        """
+        Execute a command on a specified node from asyncio code.
+
+        Requires the asyncssh backend. Can be awaited from any event loop; the
+        command itself runs on the agent's loop.
+
+        Args:
+            node (str): Node identifier to run command on
+            cmd (str): Command to execute
+            exit_on_err (bool): Whether to exit program if command fails
+            capture_output (bool): Whether to return the command's stdout
+
+        Returns:
+            tuple: (stdout_lines, stderr_lines, exit_status)
+        """
+        future = asyncio.run_coroutine_threadsafe(self._aexec(node, cmd, capture_output), self.loop_)
+        stdout, stderr, exit_status = await asyncio.wrap_future(future)
+        return self._check_result(node, cmd, stdout, stderr, exit_status, exit_on_err)
+
+    def _connect_one(self, node, key):
+        """
+        Open an SSH connection to a single node.
+
+        Args:
+            node (str): Node identifier to connect to
+            key (PKey): Private key used for authentication
+
+        Returns:
+            tuple: (node, ssh_client) where ssh_client is None if the connection failed
+        """
+        print(f"Connecting to Node {node}")
+        ssh_client = SSHClient()
+        ssh_client.set_missing_host_key_policy(AutoAddPolicy())
+        start = time.monotonic()
+        try:
+            # Authenticate with the loaded key only, without probing ~/.ssh or an agent.
+            ssh_client.connect(self._hostname(node), port=self.ssh_port_, username=self.account_username_, pkey=key,
+                               look_for_keys=False, allow_agent=False, timeout=_SSH_TIMEOUT,
+                               banner_timeout=_SSH_TIMEOUT, auth_timeout=_SSH_TIMEOUT,
+                               compress=self.node_compress_.get(node, self.compress_))
+        except (SSHException, OSError) as e:
+            print(f"Could not connect to Node {node} after {time.monotonic() - start:.1f}s: {e}")
+            ssh_client.close()
+            self.connect_errors_[node] = (type(e).__name__, str(e))
+            return node, None
+        # Applies to every channel opened on this connection from now on.
+        transport = ssh_client.get_transport()
+        transport.default_window_size = _WINDOW_SIZE
+        transport.default_max_packet_size = _MAX_PACKET_SIZE
+        transport.set_keepalive(_SSH_KEEPALIVE)
+        return node, ssh_client
+
+    def _hostname(self, node):
+        """Return a node's fully qualified hostname, including for names not in the config."""
+        return self.hostnames_.get(node) or f"{node}{self.ssh_suffix_}"
+
+    def _add_node(self, node):
+        """
+        Connect to a node and set up its connection pool, unless that was already tried.
+
+        Returns:
+            bool: Whether the node is connected
+        """
+        if node in self.ssh_pools_:
+            return True
+        with self.connect_locks_.setdefault(node, threading.Lock()):
+            if node in self.ssh_pools_:
+                return True
+            if node in self.unconnected_nodes_:
+                return False
+            _, ssh_client = self._connect_one(node, self.pkey_)
+            if ssh_client is None:
                 self.unconnected_nodes_.append(node)
+                return False
             self.ssh_clients_[node] = ssh_client
+            self.ssh_pools_[node] = _SSHPool(lambda: self._connect_one(node, self.pkey_)[1], ssh_client)
+            return True
+
+    def _pool(self, node):
+        """
+        Return the connection pool for a node, connecting to it first if needed.
 
-    def run_on_node(self, node, cmd, exit_on_err = False):
+        Raises:
+            SSHException: If the node could not be connected to
+        """
+        if not self._add_node(node):
+            error_name, error_msg = self.connect_errors_[node]
+            raise SSHException(f"Not connected to {node}: {error_name}: {error_msg}")
+        return self.ssh_pools_[node]
+
+    def run_on_node(self, node, cmd, exit_on_err = False, capture_output = True, callback = None):
         """
         Execute a command on a specified node via SSH.
         
@@ -70,49 +626,163 @@ class CloudLabAgent:
             node (str): Node identifier to run command on
             cmd (str): Command to execute
             exit_on_err (bool): Whether to exit program if command fails
+            capture_output (bool): Whether to return the command's stdout; when False
+                                   stdout is discarded and an empty list is returned for it,
+                                   while stderr is still returned
+            callback (callable): If given, called as callback(line, stream) for each output
+                                 line as it arrives, with stream "stdout" or "stderr"; the
+                                 output is then not kept and empty lists are returned;
+                                 capture_output and the persistent shell are not used
             
         Returns:
             tuple: (stdout_lines, stderr_lines, exit_status)
         """
-        _, stdout, stderr = self.ssh_clients_[node].exec_command(cmd)
-        stdout_lines = stdout.readlines()
-        stderr_lines = stderr.readlines()
-        exit_status = stdout.channel.recv_exit_status()
-        if exit_status:
-            print(f"STDOUT : {node} {cmd} = ")
-            print(' '.join(stdout_lines))
-            print(f"STDERR : {node} {cmd} = ")
-            print(' '.join(stderr_lines))
-            if exit_on_err:
-                exit(1)
+        if not self._add_node(node):
+            # Report the failed connect like ssh does (exit status 255) instead
+            # of failing inside the connection pool on every call.
+            error_name, error_msg = self.connect_errors_[node]
+            stderr = f"Not connected to {node}: {error_name}: {error_msg}\n".encode()
+            return self._check_result(node, cmd, b"", stderr, 255, exit_on_err)
+        if callback is not None:
+            lines = self.run_on_node_iter(node, cmd)
+            try:
+                while True:
+                    callback(*next(lines))
+            except StopIteration as done:
+                exit_status = done.value
+            finally:
+                lines.close()
+            return self._check_result(node, cmd, b"", b"", exit_status, exit_on_err)
+        if self.persistent_shell_:
+            stdout, stderr, exit_status = self._shell(node).run(cmd)
+            if not capture_output:
+                stdout = b""
+            return self._check_result(node, cmd, stdout, stderr, exit_status, exit_on_err)
+        with self._pool(node).acquire() as client:
+            chan = client.get_transport().open_session()
+            chan.exec_command(cmd)
+            stdout, stderr, exit_status = _read_channel(chan, capture_output)
+            chan.close()
+        return self._check_result(node, cmd, stdout, stderr, exit_status, exit_on_err)
+
+    def run_on_node_iter(self, node, cmd):
+        """
+        Execute a command on a specified node, yielding its output lines as they arrive.
+
+        Lets a caller follow a long-running command's progress, or stop reading
+        once it has seen the line it needs; leaving the loop early closes the
+        channel. The command's exit status is the generator's return value.
+
+        Args:
+            node (str): Node identifier to run command on
+            cmd (str): Command to execute
+
+        Yields:
+            tuple: (line, stream) where stream is "stdout" or "stderr"
+        """
+        with self._pool(node).acquire() as client:
+            chan = client.get_transport().open_session()
+            try:
+                chan.exec_command(cmd)
+                pending = {"stdout": b"", "stderr": b""}
+                while True:
+                    select.select([chan], [], [], 1.0)
+                    chunks = []
+                    while chan.recv_ready():
+                        chunks.append(("stdout", chan.recv(_RECV_SIZE)))
+                    while chan.recv_stderr_ready():
+                        chunks.append(("stderr", chan.recv_stderr(_RECV_SIZE)))
+                    for stream, data in chunks:
+                        *lines, pending[stream] = (pending[stream] + data).split(b"\n")
+                        for line in lines:
+                            yield line.decode("utf-8", "replace") + "\n", stream
+                    if (chan.eof_received or chan.closed) and not chan.recv_ready() and not chan.recv_stderr_ready():
+                        break
+                for stream, rest in pending.items():
+                    if rest:
+                        yield rest.decode("utf-8", "replace"), stream
+                return chan.recv_exit_status()
+            finally:
+                chan.close()
+
+    def _shell(self, node):
+        """Return the persistent shell on a node, starting it if needed."""
+        with self.shells_lock_:
+            shell = self.shells_.get(node)
+            if shell is None or shell.closed:
+                shell = _Shell(self._pool(node).primary_)
+                self.shells_[node] = shell
+            return shell
+
+    def run_on_shell(self, node, cmd, exit_on_err = False):
+        """
+        Execute a command in a persistent shell on a specified node.
+
+        Unlike run_on_node(), no new SSH channel is opened per command, which
+        saves a round trip for each of a series of short commands. Commands on
+        the same node run one at a time, and shell state such as the working
+        directory and variables carries over from one command to the next.
+
+        Args:
+            node (str): Node identifier to run command on
+            cmd (str): Command to execute
+            exit_on_err (bool): Whether to exit program if command fails
+
+        Returns:
+            tuple: (stdout_lines, stderr_lines, exit_status)
+        """
+        stdout, stderr, exit_status = self._shell(node).run(cmd)
+        return self._check_result(node, cmd, stdout, stderr, exit_status, exit_on_err)
+
+    def _check_result(self, node, cmd, stdout, stderr, exit_status, exit_on_err):
+        """
+        Split a command's output into lines and report it if the command failed.
+
+        Returns:
+            tuple: (stdout_lines, stderr_lines, exit_status)
+        """
+        stdout_lines = _split_lines(stdout)
+        stderr_lines = _split_lines(stderr)
+        if exit_status and self.verbose_:
+            # One print per failure, so reports from concurrent runs do not interleave.
+            print(f"STDOUT : {node} {cmd} = \n{''.join(stdout_lines)}\n"
+                  f"STDERR : {node} {cmd} = \n{''.join(stderr_lines)}")
+        if exit_status and exit_on_err:
+            exit(1)
         return stdout_lines, stderr_lines, exit_status
     
-    def concurrent_run(self, nodes, cmd, exit_on_err = False):
+    def concurrent_run(self, nodes, cmd, exit_on_err = False, capture_output = True):
         """
-        Execute a command concurrently across multiple nodes using threads.
+        Execute a command concurrently across multiple nodes using the agent's thread pool.
         
         Args:
             nodes (list): List of node identifiers to run command on
-            cmd (str): Command to execute on each node
+            cmd (str|dict): Command to execute on each node, or a dictionary mapping
+                            each node identifier to its own command
             exit_on_err (bool): Whether to exit program if command fails
+            capture_output (bool): Whether to return the command's stdout
             
         Returns:
             dict: Dictionary mapping node identifiers to their command execution results
                   Each result is a tuple of (stdout_lines, stderr_lines, exit_status)
         """
-        threads = {}
-        results = {}
-        for node in nodes:
-            thread = ThreadWithRetval(target=self.run_on_node, args=(node, cmd, exit_on_err))
-            threads[node] = thread
-            thread.start()
+        cmds = cmd if isinstance(cmd, dict) else dict.fromkeys(nodes, cmd)
+        if self.backend_ == "asyncssh":
+            async def gather():
+                return await asyncio.gather(*[self._aexec(node, cmds[node], capture_output) for node in nodes])
+            return {node: self._check_result(node, cmds[node], stdout, stderr, exit_status, exit_on_err)
+                    for node, (stdout, stderr, exit_status) in zip(nodes, self._run_coroutine(gather()))}
 
-        for node in nodes:
-            results[node] = threads[node].join()
+        if len(nodes) == 1:
+            # Nothing to overlap; skip the hand-off to a worker thread.
+            node = nodes[0]
+            return {node: self.run_on_node(node, cmds[node], exit_on_err, capture_output)}
 
-        return results
+        futures = {node: self.executor_.submit(self.run_on_node, node, cmds[node], exit_on_err, capture_output)
+                   for node in nodes}
+        return {node: future.result() for node, future in futures.items()}
     
-    def run(self, nodes, cmd, exit_on_err = False):
+    def run(self, nodes, cmd, exit_on_err = False, capture_output = True):
         """
         Execute a command on one or multiple nodes.
         
@@ -120,18 +790,121 @@ class CloudLabAgent:
             nodes (str|list): Target node(s) - can be "all", a list of nodes, or a single node
             cmd (str): Command to execute
             exit_on_err (bool): Whether to exit program if command fails
+            capture_output (bool): Whether to return the command's stdout
             
         Returns:
             dict|tuple: Results from command execution
         """
         if nodes == "all":
-            return self.concurrent_run(self.nodes_, cmd, exit_on_err)
+            return self.concurrent_run(self.nodes_, cmd, exit_on_err, capture_output)
         elif isinstance(nodes, list) and len(nodes) > 0 :
-            return self.concurrent_run(nodes, cmd, exit_on_err)
+            return self.concurrent_run(nodes, cmd, exit_on_err, capture_output)
         else:
-            return self.run_on_node(nodes, cmd, exit_on_err)
+            return self.run_on_node(nodes, cmd, exit_on_err, capture_output)
+
+    def run_script(self, nodes, cmds, exit_on_err = False, shell = "bash", trace = False):
+        """
+        Execute a sequence of commands as one script on one or multiple nodes.
+
+        The commands are sent to the shell as a heredoc in a single exec, so a
+        series of small steps costs one SSH round trip instead of one per step.
+
+        Args:
+            nodes (str|list): Target node(s) - can be "all", a list of nodes, or a single node
+            cmds (list): Commands to execute, in order
+            exit_on_err (bool): Whether to exit program if the script fails
+            shell (str): Shell to run the script with
+            trace (bool): Whether to run the shell with -x, echoing each command to stderr
+
+        Returns:
+            dict|tuple: Results from command execution, as returned by run()
+        """
+        delimiter = f"__CLOUDLAB_EOF_{uuid.uuid4().hex}__"
+        payload = "\n".join(cmds)
+        flags = "-x -s" if trace else "-s"
+        return self.run(nodes, f"{shell} {flags} <<'{delimiter}'\n{payload}\n{delimiter}", exit_on_err)
+
+    def _fan_out(self, nodes, cmd, exit_on_err = False, max_workers = _MAX_FAN_OUT_WORKERS):
+        """
+        Execute a command on multiple nodes with a bounded number of threads.
+
+        Args:
+            nodes (list): List of node identifiers to run command on
+            cmd (str): Command to execute on each node
+            exit_on_err (bool): Whether to exit program if command fails
+            max_workers (int): Maximum number of nodes running the command at once
+
+        Returns:
+            dict: Dictionary mapping node identifiers to their command execution results
+                  Each result is a tuple of (stdout_lines, stderr_lines, exit_status)
+        """
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(nodes)))) as ex:
+            return dict(zip(nodes, ex.map(lambda node: self.run_on_node(node, cmd, exit_on_err), nodes)))
+
+    @contextmanager
+    def _sftp(self, node):
+        """
+        Check out an SFTP session to a node for the duration of a with block.
+
+        Idle sessions are kept open and handed out again, so repeated transfers
+        skip the channel open and SFTP subsystem negotiation. A new session is
+        opened when none is idle, so concurrent transfers do not share one.
+        The pooled connection under the session stays checked out for the
+        whole transfer, so it cannot be evicted mid-transfer.
+        """
+        with self._pool(node).acquire() as client:
+            with self.sftp_lock_:
+                idle = self.sftp_clients_.setdefault(client, [])
+                ftp_client = idle.pop() if idle else None
+            if ftp_client is None or ftp_client.get_channel().closed:
+                ftp_client = client.open_sftp()
+            try:
+                yield ftp_client
+            finally:
+                with self.sftp_lock_:
+                    self.sftp_clients_[client].append(ftp_client)
+
+    @staticmethod
+    def _evict_idle_clients(agent_ref, stop):
+        """Periodically close pooled connections, and their SFTP sessions, left idle."""
+        while not stop.wait(_POOL_IDLE_TIMEOUT):
+            agent = agent_ref()
+            if agent is None:
+                return
+            for pool in list(agent.ssh_pools_.values()):
+                for client in pool.evict_idle(_POOL_IDLE_TIMEOUT):
+                    agent._close_sftp_sessions(client)
+            del agent
 
-    def scp(self, node, local_path, remote_path, exit_on_err = False):
+    def close(self):
+        """Close all shells, SFTP sessions and SSH connections held by the agent; safe to call twice."""
+        if self.evict_stop_.is_set():
+            return
+        self.evict_stop_.set()
+        atexit.unregister(self.close)
+        if self.loop_ is not None:
+            async def close_async_conns():
+                for conn in self.async_conns_.values():
+                    conn.close()
+                    await conn.wait_closed()
+            self._run_coroutine(close_async_conns())
+            self.async_conns_ = {}
+            self.loop_.call_soon_threadsafe(self.loop_.stop)
+            self.loop_ = None
+        with self.shells_lock_:
+            for shell in self.shells_.values():
+                shell.close()
+            self.shells_.clear()
+        with self.sftp_lock_:
+            for ftp_clients in self.sftp_clients_.values():
+                for ftp_client in ftp_clients:
+                    ftp_client.close()
+            self.sftp_clients_.clear()
+        for pool in self.ssh_pools_.values():
+            pool.close()
+        self.executor_.shutdown(wait=True)
+
+    def scp(self, node, local_path, remote_path, exit_on_err = False, confirm = True):
         """
         Copy a file from local machine to remote node.
         
@@ -140,12 +913,13 @@ class CloudLabAgent:
             local_path (str): Path to source file on local machine
             remote_path (str): Destination path on remote node
             exit_on_err (bool): Whether to exit program if transfer fails
+            confirm (bool): Whether to stat the remote file afterwards to check its size,
+                            which costs one more round trip per file
         """
-        ftp_client = self.ssh_clients_[node].open_sftp()
-        ftp_client.put(local_path, remote_path)
-        ftp_client.close()
+        with self._sftp(node) as ftp_client:
+            ftp_client.put(local_path, remote_path, confirm=confirm)
 
-    def scpget(self, node, local_path, remote_path, exit_on_err = False):
+    def scpget(self, node, local_path, remote_path, exit_on_err = False, pipeline_depth = _SFTP_PIPELINE_DEPTH):
         """
         Copy a file from remote node to local machine.
         
@@ -154,10 +928,179 @@ class CloudLabAgent:
             local_path (str): Destination path on local machine
             remote_path (str): Path to source file on remote node
             exit_on_err (bool): Whether to exit program if transfer fails
+            pipeline_depth (int): Maximum number of read requests kept in flight,
+                                  None to request the whole file at once
+        """
+        with self._sftp(node) as ftp_client:
+            ftp_client.get(remote_path, local_path, max_concurrent_prefetch_requests=pipeline_depth)
+
+    def scp_many(self, node, pairs, concurrency = _SFTP_CONCURRENCY, confirm = True):
+        """
+        Copy several files from local machine to remote node.
+
+        Files are uploaded concurrently, each worker on its own SFTP session.
+        Remote parent directories must already exist.
+
+        Args:
+            node (str): Target node identifier
+            pairs (list): (local_path, remote_path) tuples to transfer
+            concurrency (int): Maximum number of files transferred at once
+            confirm (bool): Whether to stat each remote file afterwards to check its size
+        """
+        pairs = list(pairs)
+        with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(pairs)))) as ex:
+            list(ex.map(lambda paths: self.scp(node, *paths, confirm=confirm), pairs))
+
+    def scp_dir(self, node, local_dir, remote_dir, concurrency = _SFTP_CONCURRENCY):
+        """
+        Copy a directory tree from local machine to remote node.
+
+        Remote directories are created as needed, then files are uploaded
+        concurrently, each worker on its own SFTP session, so a tree of many
+        small files is not bound by one round trip per file.
+
+        Args:
+            node (str): Target node identifier
+            local_dir (str): Path to source directory on local machine
+            remote_dir (str): Destination directory on remote node
+            concurrency (int): Maximum number of files transferred at once
+        """
+        files = []
+        with self._sftp(node) as ftp_client:
+            for root, _, filenames in os.walk(local_dir):
+                relative_root = os.path.relpath(root, local_dir).replace(os.sep, "/")
+                remote_root = posixpath.normpath(posixpath.join(remote_dir, relative_root))
+                try:
+                    ftp_client.mkdir(remote_root)
+                except IOError:
+                    # The directory already exists.
+                    pass
+                files.extend((os.path.join(root, filename), posixpath.join(remote_root, filename)) for filename in filenames)
+        self.scp_many(node, files, concurrency=concurrency)
+
+    def _rsync(self, node, src, dst, exit_on_err):
+        """
+        Run rsync over ssh between the local machine and a node.
+
+        The ssh client authenticates with the agent's key file non-interactively,
+        so a passphrase-protected key must also be loaded in an ssh-agent.
+
+        Returns:
+            tuple: (stdout_lines, stderr_lines, exit_status)
+        """
+        ssh = (f"ssh -p {self.ssh_port_} -i {shlex.quote(self.account_ssh_key_filename_)} -o BatchMode=yes "
+               "-o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o LogLevel=ERROR")
+        args = ["rsync", "-az", "-e", ssh, src, dst]
+        result = subprocess.run(args, capture_output=True)
+        return self._check_result(node, shlex.join(args), result.stdout, result.stderr, result.returncode, exit_on_err)
+
+    def _sftp_fallback(self, node, description, transfer, exit_on_err):
+        """
+        Run an SFTP transfer in place of rsync, reporting it like a command.
+
+        Returns:
+            tuple: (stdout_lines, stderr_lines, exit_status)
+        """
+        try:
+            transfer()
+        except (IOError, SSHException) as e:
+            return self._check_result(node, description, b"", f"{type(e).__name__}: {e}".encode(), 1, exit_on_err)
+        return [], [], 0
+
+    def rsync_to(self, node, local_path, remote_path, exit_on_err = False):
+        """
+        Copy a file or directory tree from local machine to remote node with rsync.
+
+        rsync sends file metadata in bulk and only transfers files that
+        changed, so re-syncing a large tree costs far fewer round trips than
+        SFTP. Falls back to scp()/scp_dir() when rsync is not installed
+        locally. Follows rsync's trailing-slash semantics for directories.
+
+        Args:
+            node (str): Target node identifier
+            local_path (str): Path to source file or directory on local machine
+            remote_path (str): Destination path on remote node
+            exit_on_err (bool): Whether to exit program if transfer fails
+
+        Returns:
+            tuple: (stdout_lines, stderr_lines, exit_status)
+        """
+        if shutil.which("rsync") is None:
+            transfer = self.scp_dir if os.path.isdir(local_path) else self.scp
+            return self._sftp_fallback(node, f"sftp put {local_path} {remote_path}",
+                                       lambda: transfer(node, local_path, remote_path), exit_on_err)
+        remote = f"{self.account_username_}@{self._hostname(node)}:{remote_path}"
+        return self._rsync(node, local_path, remote, exit_on_err)
+
+    def rsync_from(self, node, remote_path, local_path, exit_on_err = False):
+        """
+        Copy a file or directory tree from remote node to local machine with rsync.
+
+        Falls back to scpget() when rsync is not installed locally, which
+        only handles a single file.
+
+        Args:
+            node (str): Source node identifier
+            remote_path (str): Path to source file or directory on remote node
+            local_path (str): Destination path on local machine
+            exit_on_err (bool): Whether to exit program if transfer fails
+
+        Returns:
+            tuple: (stdout_lines, stderr_lines, exit_status)
+        """
+        if shutil.which("rsync") is None:
+            return self._sftp_fallback(node, f"sftp get {remote_path} {local_path}",
+                                       lambda: self.scpget(node, local_path, remote_path), exit_on_err)
+        remote = f"{self.account_username_}@{self._hostname(node)}:{remote_path}"
+        return self._rsync(node, remote, local_path, exit_on_err)
+
+    def _close_sftp_sessions(self, client):
+        """Close the idle SFTP sessions cached for a pooled client."""
+        with self.sftp_lock_:
+            for ftp_client in self.sftp_clients_.pop(client, []):
+                ftp_client.close()
+
+    def set_compression(self, nodes, enable):
+        """
+        Turn SSH compression on or off for the connections to specified nodes.
+
+        Compression is fixed when a connection is negotiated, so idle
+        connections are closed and reopened with the new setting: the node's
+        first connection is replaced by a fresh one, and the others are
+        reopened when next needed. Connections in use at the time keep their
+        current setting until they go idle and are evicted. Persistent shells
+        on a replaced connection are restarted on next use. Worth enabling
+        for commands or downloads producing large, repetitive text output
+        over a slow link. Only affects the paramiko connections.
+
+        Args:
+            nodes (str|list): Target node(s) - can be "all", a list of nodes, or a single node
+            enable (bool): Whether to compress traffic to the node(s)
         """
-        ftp_client = self.ssh_clients_[node].open_sftp()
-        ftp_client.get(remote_path, local_path)
-        ftp_client.close()
+        if nodes == "all":
+            nodes = self.nodes_
+        elif not isinstance(nodes, list):
+            nodes = [nodes]
+        for node in nodes:
+            self.node_compress_[node] = enable
+            pool = self.ssh_pools_.get(node)
+            if pool is None:
+                continue
+            for client in pool.evict_idle(0):
+                self._close_sftp_sessions(client)
+            transport = pool.primary_.get_transport()
+            if transport is not None and (transport.local_compression != "none") == enable:
+                continue
+            _, ssh_client = self._connect_one(node, self.pkey_)
+            if ssh_client is None:
+                continue
+            replaced = pool.replace_primary(ssh_client)
+            if replaced is None:
+                ssh_client.close()
+                continue
+            self.ssh_clients_[node] = ssh_client
+            self._close_sftp_sessions(replaced)
+            replaced.close()
 
     def reboot(self, nodes, exit_on_err = False):
         """
@@ -173,7 +1116,7 @@ class CloudLabAgent:
         cmd =  '''
         sudo reboot
         '''
-        return self.run(nodes, cmd, exit_on_err)
+        return self.run(nodes, cmd, exit_on_err, capture_output=False)
             
     def install_deps(self, nodes, exit_on_err = False):
         """
@@ -186,16 +1129,11 @@ class CloudLabAgent:
         Returns:
             tuple: Result of run() command if single node, None if 'all'
         """
-        cmd = '''
-        sudo apt-get update
-        sudo apt-get install -y htop powercap-utils python3 python3-pip linux-tools-$(uname -r) linux-cloud-tools-$(uname -r) git libssl-dev libz-dev luarocks tcpdump
-        pip3 install aiohttp asyncio pandas numpy scikit-learn matplotlib psutil
-        sudo luarocks install luasocket
-        yes | sudo apt install python3-locust
-        pip install locust-plugins
-        pip install locust-swarm
-
-        '''
+        cmd = _INSTALL_DEPS_SH
+        if nodes == "all":
+            nodes = self.nodes_
+        if isinstance(nodes, list):
+            return self._fan_out(nodes, cmd, exit_on_err)
         return self.run(nodes, cmd, exit_on_err)
 
 
@@ -210,26 +1148,11 @@ class CloudLabAgent:
         Returns:
             tuple: Result of run() command if single node, None if 'all'
         """
-        cmd = '''
-        # Add Docker's official GPG key:
-        sudo apt-get update
-        sudo apt-get install ca-certificates curl -y
-        sudo install -m 0755 -d /etc/apt/keyrings
-        sudo curl -fsSL https://download.docker.com/linux/ubuntu/gpg -o /etc/apt/keyrings/docker.asc
-        sudo chmod a+r /etc/apt/keyrings/docker.asc
-
-        # Add the repository to Apt sources:
-        echo \
-        "deb [arch=$(dpkg --print-architecture) signed-by=/etc/apt/keyrings/docker.asc] https://download.docker.com/linux/ubuntu \
-        $(. /etc/os-release && echo "$VERSION_CODENAME") stable" | \
-        sudo tee /etc/apt/sources.list.d/docker.list > /dev/null
-        sudo apt-get update
-
-
-        sudo apt-get install docker-ce docker-ce-cli containerd.io docker-buildx-plugin docker-compose-plugin -y
-
-        sudo chmod 666 /var/run/docker.sock
-        '''
+        cmd = _INSTALL_DOCKER_SH
+        if nodes == "all":
+            nodes = self.nodes_
+        if isinstance(nodes, list):
+            return self._fan_out(nodes, cmd, exit_on_err)
         return self.run(nodes, cmd, exit_on_err)
 
 
@@ -244,9 +1167,13 @@ class CloudLabAgent:
             tuple: (stdout_lines, stderr_lines, exit_status) from swarm initialization
         """
 
-        cmd = f"sudo docker swarm init --advertise-addr 10.0.1.{int(self.master_node_.split('-')[-1]) + 1} --data-path-addr 10.0.1.{int(self.master_node_.split('-')[-1]) + 1}"
+        master_ip = self.node_ips_[self.master_node_]
+        cmd = f"sudo docker swarm init --advertise-addr {master_ip} --data-path-addr {master_ip}"
         stdout, stderr , exit_status = self.run_on_node(self.master_node_, cmd, exit_on_err=True) 
-        worker_join_token = stdout[4].strip()
+        match = self._JOIN_RE.search(''.join(stdout))
+        if match is None:
+            raise RuntimeError(f"No worker join command in docker swarm init output: {stdout}")
+        worker_join_token = "sudo " + match.group(1)
         print(f"Join token is '{worker_join_token}' ")
         self.worker_join_token_ = worker_join_token
         return stdout, stderr, exit_status
@@ -263,12 +1190,16 @@ class CloudLabAgent:
         Returns:
             tuple: Dictionaries of (stdouts, stderrs, exit_statuses) keyed by node
         """
+        cmds = {}
+        for node in nodes:
+            print(f"Trying to join node {node} as worker to swarm")
+            node_ip = self.node_ips_[node]
+            cmds[node] = self.worker_join_token_ + f" --advertise-addr {node_ip} --data-path-addr {node_ip}"
+
         stdouts = {}
         stderrs = {}
         exit_statuses = {}
-        for node in nodes:
-            print(f"Trying to join node {node} as worker to swarm")
-            stdout, stderr, exit_status = self.run_on_node(node, self.worker_join_token_ + f" --advertise-addr 10.0.1.{int(node.split('-')[-1]) + 1} --data-path-addr 10.0.1.{int(node.split('-')[-1]) + 1}")
+        for node, (stdout, stderr, exit_status) in self.concurrent_run(nodes, cmds).items():
             stdouts[node] = stdout
             stderrs[node] = stderr
             exit_statuses[node] = exit_status
@@ -285,10 +1216,7 @@ class CloudLabAgent:
         Returns:
             tuple: Result of run() command
         """
-        cmd = '''
-        sudo docker swarm leave -f
-        '''
-        return self.run_on_node(node, cmd)
+        return self.run_on_node(node, self._LEAVE_SWARM_CMD, capture_output=False)
     
     def create_docker_swarm(self, exit_on_err = False):
         """
@@ -328,12 +1256,13 @@ class CloudLabAgent:
         stdouts = {}
         stderrs = {}
         exit_statuses = {}
-        for node in self.nodes_:
-            if node != self.master_node_:   
-                stdout, stderr, exit_status = self.leave_swarm(node)
-                stdouts[node] = stdout
-                stderrs[node] = stderr
-                exit_statuses[node] = exit_status
+        # Workers leave concurrently; the master leaves last.
+        worker_nodes = [node for node in self.nodes_ if node != self.master_node_]
+        results = self.concurrent_run(worker_nodes, self._LEAVE_SWARM_CMD, capture_output=False)
+        for node, (stdout, stderr, exit_status) in results.items():
+            stdouts[node] = stdout
+            stderrs[node] = stderr
+            exit_statuses[node] = exit_status
         stdout, stderr, exit_status = self.leave_swarm(self.master_node_)
         stdouts[self.master_node_] = stdout
         stderrs[self.master_node_] = stderr
@@ -354,10 +1283,26 @@ class CloudLabAgent:
             dict: Dictionary mapping node identifiers to their command execution results
                   Each result is a tuple of (stdout_lines, stderr_lines, exit_status)
         """
+        # All updates run in one exec on the master. After each one its exit
+        # status is printed behind a random marker on stdout, and the marker
+        # alone on stderr, so the output can be split back per node.
+        marker = uuid.uuid4().hex
+        cmds = {node: f"docker node update --label-add {key}={value} {self._hostname(node)}" for node in nodes}
+        script = "".join(f"{cmd}\nprintf '\\n{marker} %d\\n' $?\nprintf '\\n{marker}\\n' >&2\n" for cmd in cmds.values())
+        stdout, stderr, exit_status = self.run_on_node(self.master_node_, script)
+        stdout_parts = re.split(rf"\n{marker} (\d+)\n", "".join(stdout))
+        stderr_parts = "".join(stderr).split(f"\n{marker}\n")
+
         results = {}
-        for node in nodes:
-            cmd = f"docker node update --label-add {key}={value} {node}{self.ssh_suffix_}"
-            results[node] = self.run(self.master_node_, cmd)
+        for i, (node, cmd) in enumerate(cmds.items()):
+            if 2 * i + 1 < len(stdout_parts):
+                node_stdout, node_exit_status = stdout_parts[2 * i], int(stdout_parts[2 * i + 1])
+            else:
+                # The script stopped before reaching this node.
+                node_stdout, node_exit_status = "", exit_status or -1
+            node_stderr = stderr_parts[i] if i < len(stderr_parts) else ""
+            results[node] = self._check_result(self.master_node_, cmd, node_stdout.encode(), node_stderr.encode(),
+                                               node_exit_status, exit_on_err)
         return results
 
     def turn_intel_pstate_driver(self, nodes, option, exit_on_err = False):
@@ -375,19 +1320,22 @@ class CloudLabAgent:
         if option == "on":
             edit_grub_cmd = '''
             sudo sed -i 's/^GRUB_CMDLINE_LINUX_DEFAULT="intel_pstate=disable"/GRUB_CMDLINE_LINUX_DEFAULT=""/g' /etc/default/grub
-            sudo grub-mkconfig -o /boot/grub/grub.cfg
             '''
         elif option == "off":
             edit_grub_cmd = '''
             sudo sed -i 's/^GRUB_CMDLINE_LINUX_DEFAULT=""/GRUB_CMDLINE_LINUX_DEFAULT="intel_pstate=disable"/g' /etc/default/grub
-            sudo grub-mkconfig -o /boot/grub/grub.cfg
             '''
         else:
             print(f"{option} option not recognized!, Only options 'on' and 'off' are allowed")
             return [],[],-1
 
-        self.run(nodes, edit_grub_cmd, exit_on_err=True)
-        self.reboot(nodes)
+        # Reboot in the same exec once GRUB is updated. The reboot is detached
+        # and slightly delayed so the command can report its exit status
+        # before sshd goes down.
+        cmd = edit_grub_cmd + '''
+        sudo grub-mkconfig -o /boot/grub/grub.cfg && { { sleep 1; sudo reboot; } > /dev/null 2>&1 & }
+        '''
+        self.run(nodes, cmd, exit_on_err=True)
 
     def set_power_governor(self, nodes, governor, exit_on_err = False):
         """
@@ -401,24 +1349,33 @@ class CloudLabAgent:
         Returns:
             tuple: Result of run() command
         """
-        cmd = f"sudo cpupower frequency-set -g {governor}"
-        return self.run(nodes, cmd, exit_on_err)
+        cmd = self._GOVERNOR_CMD.format(governor=governor)
+        return self.run(nodes, cmd, exit_on_err, capture_output=False)
 
-    def set_frequency(self, nodes, cpus, frequency, exit_on_err = False):
+    def set_frequency(self, nodes, cpus, frequency = None, exit_on_err = False):
         """
         Set CPU frequency for specified cores on a node.
         
         Args:
             node (str): Node identifier
-            cpus (str): CPU cores to configure (e.g., "0-3" or "0,1,2,3")
-            frequency (str): Frequency to set (e.g., "2.4GHz")
+            cpus (str|list): CPU cores to configure (e.g., "0-3" or "0,1,2,3"), or a list of
+                             (cpus, frequency) pairs to apply in a single command
+            frequency (str): Frequency to set (e.g., "2.4GHz"), unused when cpus is a list
             exit_on_err (bool): Whether to exit program if command fails
             
         Returns:
             tuple: Result of run() command
+
+        Raises:
+            ValueError: If cpus is a single range and no frequency is given
         """
-        cmd = f"sudo cpupower -c {cpus} frequency-set -f {frequency}"
-        return self.run(nodes ,cmd, exit_on_err)
+        if isinstance(cpus, list):
+            cmd = " && ".join(self._FREQUENCY_CMD.format(cpus=c, frequency=f) for c, f in cpus)
+        elif frequency is None:
+            raise ValueError(f"A frequency is required to set the frequency of cpus {cpus}")
+        else:
+            cmd = self._FREQUENCY_CMD.format(cpus=cpus, frequency=frequency)
+        return self.run(nodes ,cmd, exit_on_err, capture_output=False)
 
     def turn_turboboost(self, nodes, option, power_driver, exit_on_err = False):
         """
@@ -527,7 +1484,9 @@ class CloudLabAgent:
         """
         if wrk_path == "default":
             wrk_path = f"/home/{self.account_username_}/DeathStarBench/wrk2"
-        cmd = f"ulimit -n {wrk_params['ulimit']} && {wrk_path}/wrk -D {wrk_params['dist']} -t {wrk_params['threads']} -c {wrk_params['connections']} -d{wrk_params['duration']} -R{wrk_params['rate']} -T{wrk_params['timeout']} -s {wrk_path}/{wrk_params['script']} {wrk_params['url']} {wrk_params['extra_params']}" 
+        params = {key: shlex.quote(str(value)) for key, value in wrk_params.items()}
+        cmd = self._WRK_CMD.format(**{**params, "wrk_path": wrk_path, "script": wrk_params['script'],
+                                      "extra_params": wrk_params['extra_params']})
         print(cmd)
         return self.run_on_node(node, cmd, exit_on_err)
     
@@ -558,7 +1517,9 @@ class CloudLabAgent:
         Returns:
             tuple: Result of run() command (stdout, stderr, exit_status)
         """
-        cmd = f"locust --headless -f {locust_params['script']} -H {locust_params['url']} --tag {locust_params['tags']} --processes {locust_params['processes']} -w {locust_params['wait_distrib']} -tu {locust_params['throughput_per_user']} -u {locust_params['max_users']} -r {locust_params['user_spawn_rate']} -t{locust_params['duration']} --csv {locust_params['output_csv']} {locust_params['extra_params']}" 
+        params = {key: shlex.quote(str(value)) for key, value in locust_params.items()}
+        cmd = self._LOCUST_CMD.format(**{**params, "script": locust_params['script'], "output_csv": locust_params['output_csv'],
+                                         "extra_params": locust_params['extra_params']})
         print(cmd)
         return self.run_on_node(node, cmd, exit_on_err)
     